@@ -2,6 +2,10 @@ import unittest
 import os
 import shutil
 import tempfile
+from unittest import mock
+
+import requests
+
 from wayback_bulk_downloader import WaybackDownloader
 
 class TestWaybackDownloader(unittest.TestCase):
@@ -118,6 +122,33 @@ class TestWaybackDownloader(unittest.TestCase):
             self.assertIn("example.com", content)
             self.assertIn("SUCCESS", content)
 
+    def test_midstream_failure_is_network_error_and_leaves_no_file(self):
+        print("\nTesting mid-stream connection failure...")
+        # A connection that dies while the body streams must be reported as
+        # a network error (not "File Write Error") and must not leave a
+        # truncated file behind for skip_existing to treat as complete.
+        def flaky_chunks():
+            yield b"<html>partial snapshot data"
+            raise requests.exceptions.ConnectionError("Connection broken: IncompleteRead")
+
+        response = mock.MagicMock()
+        response.raise_for_status.return_value = None
+        response.headers = {'Memento-Datetime': 'Thu, 01 Jan 2015 00:00:00 GMT'}
+        response.url = "https://web.archive.org/web/20150101000000/http://example.com"
+        response.iter_content.return_value = flaky_chunks()
+        response.__enter__.return_value = response
+        self.downloader.session = mock.MagicMock()
+        self.downloader.session.get.return_value = response
+
+        captured = []
+        results = self.downloader.download_url("http://example.com", on_progress=captured.append)
+
+        self.assertEqual(results['failed'], 1)
+        self.assertEqual(results['success'], 0)
+        self.assertIn("Connection broken", captured[0]['error_message'])
+        self.assertNotIn("File Write Error", captured[0]['error_message'])
+        self.assertEqual(os.listdir(self.test_dir), [], "No file (or .part leftover) should remain")
+
     def test_template_download(self):
         print("\nTesting template download...")
         # A simple template test. 
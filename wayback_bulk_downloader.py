@@ -23,14 +23,16 @@ from the Internet Archive's Wayback Machine.
   print(f"Template download finished: {results}")
 """
 import requests
+import csv
 import os
 import time
 import re
 import argparse
 import sys
 import threading
-from queue import Queue
-from datetime import datetime, timezone
+import queue
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # --- Default Configuration ---
 DEFAULT_OUTPUT_DIR = "wayback_downloads"
@@ -41,13 +43,42 @@ DEFAULT_TIMEOUT = 45
 DEFAULT_USER_AGENT = "WaybackBulkDownloader/2.7 (Python/Requests; +https://github.com/timkmecl/wayback-bulk-downloader)"
 
 
+# Bytes marker on the Wayback landing page for URLs with no snapshot;
+# matched against raw bytes so response bodies are never decoded.
+NOT_ARCHIVED_MARKER = b"Wayback Machine has not archived that URL."
+
+# Served snapshots live under /web/<timestamp>/...; requests that end up
+# anywhere else never hit an archive.
+_RE_SNAPSHOT = re.compile(r'/web/\d')
+
+# Precompiled once; sanitize_filename runs per URL on large jobs.
+_RE_INVALID = re.compile(r'[\\/:*?"<>|]')
+_FILENAME_TRANS = str.maketrans({c: '_' for c in '\\/:*?"<>|'})
+
+
+def _host_key(url):
+    """Sort key grouping URLs by hostname; malformed URLs sort first."""
+    try:
+        return urlsplit(url).hostname or ''
+    except ValueError:
+        # e.g. a stray '[' in the authority. Let the download attempt
+        # produce the FAIL record instead of aborting job preparation.
+        return ''
+
+
+def _iso_utc_now():
+    """Current UTC time in ISO-8601 form, built on the C strftime path."""
+    t = time.time()
+    return f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(t))}.{int((t % 1) * 1_000_000):06d}+00:00"
+
+
 def sanitize_filename(url_or_string):
     """Converts a string (URL or other) into a safe filename component."""
     s = str(url_or_string)
     if s.endswith('/'): s = s[:-1]
-    s = re.sub(r'^https?:\/\/', '', s)
-    s = re.sub(r'[\\/:*?"<>|]', '_', s)
-    return (s[:200]) if len(s) > 200 else s
+    if s.startswith('https://'): s = s[8:]
+    elif s.startswith('http://'): s = s[7:]
+    return s.translate(_FILENAME_TRANS)[:200]
 
 
 class WaybackDownloader:
@@ -73,26 +104,52 @@ class WaybackDownloader:
         self.show_progress = show_progress
         self.session = requests.Session()
         self.session.headers.update({'User-Agent': self.user_agent})
+        # Size the connection pool to the thread count so every worker can
+        # keep a TLS connection to web.archive.org alive between requests.
+        # Retries — including 429 rate-limit backoff — happen inside
+        # urllib3, honoring any Retry-After the server sends.
+        pool_size = max(10, self.threads)
+        transient_retry = requests.adapters.Retry(
+            total=self.retries, connect=2, read=2, backoff_factor=2.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            respect_retry_after_header=True,
+            allowed_methods=frozenset(['GET']))
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                                max_retries=transient_retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # Worker pool is created lazily on first use and reused across jobs.
+        self._pool = None
         # Internal state reset for each job
         self._reset_state()
 
     def _reset_state(self):
-        """Resets the queue and counters for a new download job."""
-        self.q = Queue()
-        self.rate_limit_lock = threading.Lock()
-        self.log_file_lock = threading.Lock() if self.log_file else None
-        self.last_request_time = 0
+        """Resets the rate limiter and counters for a new download job."""
+        # Next allowed request time; each worker claims its slot under a
+        # lock held only for the add+store, never across time.sleep.
+        self._next_slot = time.monotonic()
+        self._rate_lock = threading.Lock()
+        self._log_q = None
         self.success_count = 0
         self.fail_count = 0
         self.skipped_count = 0
 
+    def close(self):
+        """Shuts down the worker pool and HTTP session. Call when done with the downloader."""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        self.session.close()
+
     def download_url(self, url, on_progress=None):
         """Convenience method to download a single URL."""
         return self.download_from_list([url], on_progress)
 
     def download_from_list(self, url_list, on_progress=None):
         """
-        Prepares and runs a download job from a list of URLs.
+        Prepares and runs a download job from a list of URLs. Duplicate
+        URLs are dropped before downloading, so the summary's 'total'
+        counts unique entries.
         Args:
             url_list (list): A list of URL strings to download.
             on_progress (callable, optional): Callback function for progress updates.
@@ -100,11 +157,19 @@ class WaybackDownloader:
             dict: A summary of the download results.
         """
         self._reset_state()
-        jobs = []
-        for url in url_list:
-            ts_suffix = f"_{self.timestamp}" if self.timestamp else ''
-            save_path = os.path.join(self.output_dir, sanitize_filename(url) + ts_suffix + ".html")
-            jobs.append((url, save_path))
+        # Duplicates would be fetched twice and collide on the same save
+        # path; drop them order-preservingly, then group by hostname so
+        # snapshots of the same site are requested back to back.
+        url_list = list(dict.fromkeys(url_list))
+        url_list.sort(key=_host_key)
+        # Hoist the invariants out of the per-URL loop; this runs once per
+        # entry on lists that can reach hundreds of thousands of URLs.
+        ts_suffix = f"_{self.timestamp}" if self.timestamp else ''
+        # Trailing-separator prefix turns the per-URL path build into plain
+        # string concatenation instead of os.path.join's separator logic.
+        out_prefix = os.path.join(self.output_dir, '')
+        _sf = sanitize_filename
+        jobs = [(url, out_prefix + _sf(url) + ts_suffix + ".html") for url in url_list]
         return self._run_download_job(jobs, on_progress)
 
     def download_from_template(self, template_url, params_list, on_progress=None):
@@ -118,135 +183,201 @@ class WaybackDownloader:
         Returns:
             dict: A summary of the download results.
         """
+        if '{}' not in template_url:
+            raise ValueError("template_url must contain a '{}' placeholder")
         self._reset_state()
-        jobs = []
+        # Duplicate parameters expand to duplicate URLs and save paths.
+        params_list = list(dict.fromkeys(params_list))
         subdir_name = sanitize_filename(template_url.replace('{}', ''))
         job_output_dir = os.path.join(self.output_dir, subdir_name)
+        dir_prefix = os.path.join(job_output_dir, '')
+        # Split the template once instead of re-parsing it via str.format
+        # for every parameter.
+        idx = template_url.index('{}')
+        prefix, suffix = template_url[:idx], template_url[idx + 2:]
+
+        # Numeric parameter lists (IDs, page numbers) can never contain
+        # illegal filename characters, so skip the per-parameter search.
+        if all(isinstance(p, (int, float)) or (isinstance(p, str) and p.isdigit())
+               for p in params_list):
+            jobs = [(prefix + str(p) + suffix, f"{dir_prefix}{p}.html")
+                    for p in params_list]
+            return self._run_download_job(jobs, on_progress, job_output_dir)
+
+        jobs = []
+        _has_invalid = _RE_INVALID.search
         for param in params_list:
             param_str = str(param)
-            if re.search(r'[\\/:*?"<>|]', param_str):
+            if _has_invalid(param_str):
                 print(f"Warning: Skipping invalid parameter '{param_str}' (illegal filename characters).")
                 continue
-            full_url = template_url.format(param)
-            save_path = os.path.join(job_output_dir, f"{param_str}.html")
-            jobs.append((full_url, save_path))
+            full_url = prefix + param_str + suffix
+            jobs.append((full_url, dir_prefix + param_str + ".html"))
         return self._run_download_job(jobs, on_progress, job_output_dir)
 
     def _run_download_job(self, jobs, on_progress=None, job_output_dir=None):
         """Internal method to execute a prepared list of download jobs."""
         output_dir = job_output_dir or self.output_dir
-        os.makedirs(output_dir, exist_ok=True)
+        # Create every directory the job writes into up front — one mkdir
+        # per unique directory rather than any per-job filesystem work.
+        for directory in {os.path.dirname(path) for _url, path in jobs} | {output_dir}:
+            os.makedirs(directory, exist_ok=True)
+        if self.log_file:
+            log_dir = os.path.dirname(self.log_file)
+            if log_dir:
+                os.makedirs(log_dir, exist_ok=True)
 
         # Determine the final callback. User-provided `on_progress` takes precedence.
         final_progress_callback = on_progress
         if on_progress is None and self.show_progress:
             final_progress_callback = self._default_console_handler
+        # Timestamps only matter to the log and to progress callbacks;
+        # skip formatting them when neither is active.
+        self._want_timestamps = bool(self.log_file or final_progress_callback)
+        # The Wayback URL prefix is invariant for the whole job.
+        ts_part = f"{self.timestamp}/" if self.timestamp else ""
+        self._wayback_prefix = f"https://web.archive.org/web/{ts_part}"
         
+        # One logger thread holds the file open for the whole job; workers
+        # only enqueue records instead of reopening the file per result.
+        log_fh = log_thread = None
         if self.log_file:
-            with open(self.log_file, 'w', encoding='utf-8') as lf:
-                lf.write("download_timestamp_utc,original_url,final_url,status,local_path,error_message\n")
-        
-        for url, path in jobs:
-            if self.skip_existing and os.path.exists(path):
-                self.skipped_count += 1
-                if final_progress_callback:
-                    final_progress_callback({
-                        'timestamp_utc': datetime.now(timezone.utc).isoformat(),
-                        'original_url': url, 'final_url': '', 'status': 'SKIPPED',
-                        'save_path': path, 'error_message': 'File already exists'
-                    })
-                continue
-            self.q.put((url, path))
-        
-        self.last_request_time = time.time()
-        
-        if self.q.empty():
-            return {'success': 0, 'failed': 0, 'skipped': self.skipped_count, 'total': len(jobs)}
-
-        threads = []
-        for _ in range(self.threads):
-            thread = threading.Thread(target=self._download_worker, args=(final_progress_callback,))
-            thread.daemon = True; thread.start(); threads.append(thread)
-        self.q.join()
-        self.session.close()
+            log_fh = open(self.log_file, 'w', encoding='utf-8', newline='', buffering=1 << 16)
+            csv.writer(log_fh).writerow(['download_timestamp_utc', 'original_url', 'final_url',
+                                         'status', 'local_path', 'error_message'])
+            self._log_q = queue.SimpleQueue()
+            log_thread = threading.Thread(target=self._log_drain, args=(log_fh,), daemon=True)
+            log_thread.start()
+
+        try:
+            # Snapshot the output directory once instead of stat()ing every
+            # candidate path; all job files land in output_dir.
+            existing = {entry.name for entry in os.scandir(output_dir)} if self.skip_existing else None
+
+            pending = []
+            for url, path in jobs:
+                if self.skip_existing and os.path.basename(path) in existing:
+                    self.skipped_count += 1
+                    if final_progress_callback:
+                        final_progress_callback({
+                            'timestamp_utc': _iso_utc_now(),
+                            'original_url': url, 'final_url': '', 'status': 'SKIPPED',
+                            'save_path': path, 'error_message': 'File already exists'
+                        })
+                    continue
+                pending.append((url, path))
+
+            self._next_slot = time.monotonic()
+
+            if pending:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='wb')
+                futures = [self._pool.submit(self._do_one, url, path) for url, path in pending]
+                for future in as_completed(futures):
+                    result = future.result()
+                    if result['status'] == "SUCCESS":
+                        self.success_count += 1
+                    else:
+                        self.fail_count += 1
+                    if final_progress_callback:
+                        final_progress_callback(result)
+        finally:
+            if log_fh:
+                self._log_q.put(None)
+                log_thread.join()
+                log_fh.close()
 
         return {
             'success': self.success_count, 'failed': self.fail_count,
             'skipped': self.skipped_count, 'total': len(jobs)
         }
 
-    def _download_worker(self, on_progress):
-        while not self.q.empty():
-            original_url, save_path = self.q.get()
-            
-            # Optimized rate limiting: Sleep OUTSIDE the lock
-            sleep_time = 0
-            if self.delay > 0:
-                with self.rate_limit_lock:
-                    now = time.time()
-                    elapsed = now - self.last_request_time
-                    if elapsed < self.delay:
-                        sleep_time = self.delay - elapsed
-                        self.last_request_time = now + sleep_time
+    def _do_one(self, original_url, save_path):
+        # Bind the hot attributes once; these are touched per request.
+        verbose = self.verbose
+        delay = self.delay
+        session = self.session
+        timeout = self.timeout
+
+        # Rate limiting: claim the next request slot, then sleep until that
+        # slot without blocking the other workers.
+        if delay > 0:
+            with self._rate_lock:
+                claimed = max(time.monotonic(), self._next_slot)
+                self._next_slot = claimed + delay
+            wait = claimed - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+
+        wayback_url = self._wayback_prefix + original_url
+        if verbose: self._tprint(f"  -> Thread {threading.get_ident()}: Requesting {wayback_url}")
+
+        status, final_url, error_msg = "FAIL", "", "Unknown error"
+        try:
+            with session.get(wayback_url, stream=True, timeout=timeout) as response:
+                response.raise_for_status()
+
+                chunks = response.iter_content(chunk_size=1 << 20)
+                first_chunk = b''
+                no_archive = False
+                # Real snapshots carry a Memento-Datetime header. Only
+                # when it is missing do we peek at the body, where the
+                # "not archived" marker sits in the head of the landing
+                # page, so the first chunk is enough to detect it.
+                if 'Memento-Datetime' not in response.headers:
+                    # Not redirected into /web/<timestamp>/ — the archive
+                    # is definitely absent, no need to read the body.
+                    if not _RE_SNAPSHOT.search(response.url):
+                        no_archive = True
                     else:
-                        self.last_request_time = now
-            
-            if sleep_time > 0:
-                time.sleep(sleep_time)
-
-            ts_part = f"{self.timestamp}/" if self.timestamp else ""
-            wayback_url = f"https://web.archive.org/web/{ts_part}{original_url}"
-            if self.verbose: self._tprint(f"  -> Thread {threading.get_ident()}: Requesting {wayback_url}")
-            
-            status, final_url, error_msg = "FAIL", "", "Unknown error"
-            for attempt in range(self.retries):
-                try:
-                    response = self.session.get(wayback_url, timeout=self.timeout)
-                    response.raise_for_status()
-                    
-                    if "Wayback Machine has not archived that URL." in response.text:
-                        error_msg = "No archive found"
-                        break
-                    
+                        first_chunk = next(chunks, b'')
+                        no_archive = NOT_ARCHIVED_MARKER in first_chunk
+
+                if no_archive:
+                    error_msg = "No archive found"
+                else:
+                    # Stream into a .part file and promote it only once the
+                    # body is complete, so a failure mid-download never
+                    # leaves a truncated file at save_path for
+                    # skip_existing to mistake for a finished one.
+                    part_path = save_path + '.part'
                     # Robustness: Wrap file I/O
                     try:
-                        with open(save_path, 'wb') as f:
-                            f.write(response.content)
-                        status, final_url, error_msg = "SUCCESS", response.url, ""
-                        break
+                        # Unbuffered: chunks are already syscall-sized, so
+                        # each write goes straight to the kernel, no memcpy.
+                        with open(part_path, 'wb', buffering=0) as f:
+                            f.write(first_chunk)
+                            for chunk in chunks:
+                                f.write(chunk)
+                    except requests.exceptions.RequestException:
+                        # RequestException subclasses OSError; a connection
+                        # dropped mid-stream is a network error, not a file
+                        # one — clean up and let the outer ladder report it.
+                        try: os.unlink(part_path)
+                        except OSError: pass
+                        raise
                     except (OSError, IOError) as e:
+                        try: os.unlink(part_path)
+                        except OSError: pass
                         error_msg = f"File Write Error: {e}"
-                        break
-                        
-                except requests.exceptions.HTTPError as e:
-                    error_msg = str(e)
-                    if e.response.status_code == 429:
-                        retry_delay = 5 * (attempt + 1)
-                        if self.verbose: self._tprint(f"  -> Rate limit hit for {original_url}. Retrying in {retry_delay}s...")
-                        time.sleep(retry_delay)
-                        continue
                     else:
-                        break
-                except requests.exceptions.RequestException as e:
-                    error_msg = str(e)
-                    break
-                except Exception as e:
-                    error_msg = f"Unexpected Error: {e}"
-                    break
-
-            result_info = {
-                'timestamp_utc': datetime.now(timezone.utc).isoformat(),
-                'original_url': original_url, 'final_url': final_url,
-                'status': status, 'save_path': save_path,
-                'error_message': error_msg
-            }
-            
-            if status == "SUCCESS": self.success_count += 1
-            else: self.fail_count += 1
-            
-            if self.log_file: self._log_to_file(result_info)
-            if on_progress: on_progress(result_info)
-            self.q.task_done()
+                        os.replace(part_path, save_path)
+                        status, final_url, error_msg = "SUCCESS", response.url, ""
+
+        except requests.exceptions.RequestException as e:
+            error_msg = str(e)
+        except Exception as e:
+            error_msg = f"Unexpected Error: {e}"
+
+        result_info = {
+            'timestamp_utc': _iso_utc_now() if self._want_timestamps else '',
+            'original_url': original_url, 'final_url': final_url,
+            'status': status, 'save_path': save_path,
+            'error_message': error_msg
+        }
+        
+        if self.log_file: self._log_to_file(result_info)
+        return result_info
     
     def _default_console_handler(self, result):
         """The default progress handler that mimics the CLI's output."""
@@ -255,11 +386,31 @@ class WaybackDownloader:
         else: print(f"  -> FAILED to download {result['original_url']} ({result['error_message']})")
 
     def _log_to_file(self, result):
-        with self.log_file_lock:
-            with open(self.log_file, 'a', encoding='utf-8') as lf:
-                lf.write(f'"{result["timestamp_utc"]}","{result["original_url"]}",'
-                         f'"{result["final_url"]}","{result["status"]}",'
-                         f'"{result["save_path"]}","{result["error_message"]}"\n')
+        self._log_q.put(result)
+
+    def _log_drain(self, log_fh):
+        """Logger-thread loop: batches queued results until the None sentinel."""
+        writer = csv.writer(log_fh)
+        done = False
+        while not done:
+            batch = [self._log_q.get()]
+            # Greedily drain whatever is already queued so a burst of results
+            # becomes one writerows call instead of one write per record.
+            try:
+                while len(batch) < 64:
+                    batch.append(self._log_q.get_nowait())
+            except queue.Empty:
+                pass
+            if batch[-1] is None:
+                batch.pop()
+                done = True
+            if batch:
+                writer.writerows([[r['timestamp_utc'], r['original_url'],
+                                   r['final_url'], r['status'],
+                                   r['save_path'], r['error_message']] for r in batch])
+                # Flush per batch so the log stays tail-able during long runs
+                # without paying a flush per record.
+                log_fh.flush()
     @staticmethod
     def _tprint(text):
         # A simple static print method for internal verbose use
@@ -272,9 +423,12 @@ def _read_lines_from_file(filepath):
     """Reads all non-empty, stripped lines from a text file."""
     try:
         with open(filepath, 'r', encoding='utf-8') as f:
-            return [line.strip() for line in f if line.strip()]
+            data = f.read()
     except FileNotFoundError:
         print(f"Error: Input file not found at '{filepath}'"); sys.exit(1)
+    # One slurp + C-level splitlines instead of per-line iteration; input
+    # lists can run to hundreds of thousands of URLs.
+    return [line for line in map(str.strip, data.splitlines()) if line]
 
 def main_cli():
     """Parses arguments and runs the downloader for command-line usage."""
@@ -292,7 +446,11 @@ def main_cli():
     parser.add_argument("-t", "--timestamp", help="Wayback Machine timestamp (e.g., 20150101).\nIf omitted, fetches the latest available version.")
     parser.add_argument("--threads", type=int, default=DEFAULT_THREADS, help=f"Number of concurrent download threads.\n(default: {DEFAULT_THREADS})")
     parser.add_argument("--delay", type=float, default=DEFAULT_DELAY, help=f"Controls the minimum time (in seconds) between requests across ALL threads.\n(default: {DEFAULT_DELAY})")
-    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES, help=f"Number of retries on rate-limit errors.\n(default: {DEFAULT_RETRIES})")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES,
+                        help=f"Total retries per URL for rate-limit (429), server (5xx), and\n"
+                             f"connection errors, with backoff honoring the server's Retry-After.\n"
+                             f"Retries run inside the HTTP layer, so individual attempts are not\n"
+                             f"printed in verbose mode.\n(default: {DEFAULT_RETRIES})")
     parser.add_argument("--skip-existing", action='store_true', help="Skip downloading if the output file already exists.")
     parser.add_argument("--log", help="Path to a CSV file to log all download attempts.")
     parser.add_argument("-v", "--verbose", action='store_true', help="Enable verbose output for debugging.")